@@ -1,55 +1,93 @@
 """MODULE FOR POPULATING MONGO DATABASE WITH VITEK REPORT OBJECTS OBTAINED FROM XML FILES"""
 
 """Import Dependencies"""
-from sys import argv, exit
+from sys import argv, exit, intern
 from bs4 import BeautifulSoup as Soup
-from collections import defaultdict
+from collections import defaultdict, deque
 import re
 import PyPDF2 as pdfreader
 import pymongo
 import os
+import io
+import lzma
+import tarfile
+import zipfile
+import zlib
 from datetime import datetime
+try:
+    import pycdlib
+except ImportError:
+    pycdlib = None
+
+class LabReport:
+    """Compact record of a single lab report parsed from an XML file, holding the report's source_xmlstring text until
+    the report has been built into an isolate"""
+
+    __slots__ = ('report_id', 'report_date', 'ast_report', 'source_xmlstring')
+
+    def __init__(self, report_id, report_date, ast_report, source_xmlstring):
+        self.report_id = report_id
+        self.report_date = report_date
+        self.ast_report = ast_report
+        self.source_xmlstring = source_xmlstring
+
+    def split_report(self):
+        """Return list of string elements representing the report, one for each open, close or self-closing element
+        row of source_xmlstring"""
+
+        return self.source_xmlstring.split("&gt;&lt;")
 
 class BuildReportTree:
     """Generate a tree of hash tables to represent the reports extracted from XML file"""
 
-    def __init__(self, path):
-        """Instantiate BuildReportTree object using XML file path. Will generate report_array property, a list of string
-        elements repesenting the list
+    #Bounds on the tree stored for identification (non-AST) reports
+    max_id_elements = 500
+    max_id_value_length = 256
+
+    def __init__(self, path=None, content=None):
+        """Instantiate BuildReportTree object using XML file path, or the raw file content when the file has been read
+        from an archive or disc image. Will generate lab_reports property, a queue of LabReport records each holding the
+        source_xmlstring text of a report, which is only split into elements when the report is built
         params:
-        path -- binary string"""
+        path -- binary string
+        content -- bytes or string of XML file content, used in place of path"""
         #There may be multiple reports in an xml file i.e. multiple isolates
-        self.lab_reports = []
-
-        with open(path, "r") as f:
-            handler = f.read()
-            soup = Soup(handler, 'lxml')
-            lab_reports_soup = soup.find_all('lab_report')
-            for report in lab_reports_soup:
-                report_tree = {}
-                id_ = re.compile(r'<lab_report id="([0-9]+)">').search(str(report)).group(1)
-                report_date = re.compile(r'<report_date>(\d{4}-\d{2}-\d{2})').search(str(report)).group(1)
-                report_array = str(report.find("source_xmlstring")).replace("\n", "").split("&gt;&lt;")
-                report_array = list(map(lambda x: x.replace("/", ""), report_array))
-                def is_ast_report(row):
-                    return row.find('IdTestInfo') == -1
-                report_tree['ast_report'] = all(list(map(is_ast_report, report_array)))
-                report_tree['report_id'] = id_
-                report_tree['report_data'] = report_array
-                report_tree['report_date'] = datetime.strptime(report_date, "%Y-%m-%d")
-                self.lab_reports.append(report_tree)
+        self.lab_reports = deque()
+
+        if content is None:
+            with open(path, "r") as f:
+                content = f.read()
+        soup = Soup(content, 'lxml')
+        lab_reports_soup = soup.find_all('lab_report')
+        for report in lab_reports_soup:
+            id_ = re.compile(r'[0-9]+').fullmatch(report['id']).group(0)
+            report_date = re.compile(r'(\d{4}-\d{2}-\d{2})').match(report.find('report_date').get_text()).group(1)
+            source_xmlstring = str(report.find("source_xmlstring")).replace("\n", "")
+            self.lab_reports.append(LabReport(
+                report_id=id_,
+                report_date=datetime.strptime(report_date, "%Y-%m-%d"),
+                ast_report=source_xmlstring.find('IdTestInfo') == -1,
+                source_xmlstring=source_xmlstring
+            ))
+        #Release the parse tree now the report text has been taken from it
+        soup.decompose()
 
     def build_trees(self):
-        """Using current object property report_array, generate a tree structure to represent the report"""
+        """Using current object property lab_reports, generate a tree structure to represent the report. Reports are
+        popped and split into elements one at a time, and each isolate is added to the organism summary as soon as it
+        has been built, so only one report's elements are held at once"""
         try:
             document_tree = {}
             lab_reports = []
-            for report in self.lab_reports:
-                if report['ast_report']:
+            errors = []
+            org_summary_tree = []
+            while self.lab_reports:
+                report = self.lab_reports.popleft()
+                if report.ast_report:
                     isolate_branch = dict()
-                    isolate_data = report['report_data']
-                    id_ = report['report_id']
-                    isolate_date = report['report_date']
+                    isolate_data = list(map(lambda x: x.replace("/", ""), report.split_report()))
+                    id_ = report.report_id
+                    isolate_date = report.report_date
                     headings = {'ReportData': 0,
                         'AstDetailedInfo': 0,
                         'AstTestInfo':0}
@@ -70,70 +108,112 @@ class BuildReportTree:
                             isolate_branch = self.init_document_tree(header, section, isolate_branch)
                         #Check if organism name exists, if not exclude isolate
                         if len(isolate_branch['AstTestInfo']['SelectedOrg']['orgFullName']) == 0:
-                            lab_reports.append({"error": "Report missing organism ID"})
-                        else:
-                            lab_reports.append({
-                                'isolate_id': id_,
-                                'isolate_data': isolate_branch,
-                                'isolate_report_type': 'ast',
-                                'isolate_date': isolate_date
-                            })
+                            errors.append({"error": "Report missing organism ID"})
+                            continue
+                        isolate = {
+                            'isolate_id': id_,
+                            'isolate_data': isolate_branch,
+                            'isolate_report_type': 'ast',
+                            'isolate_date': isolate_date
+                        }
                     else:
                         return {"error":"Section index error, check report_array property for inconsistencies"}
                 else:
-                    lab_reports.append({
-                        'isolate_id': report['report_id'],
-                        'isolate_data': report['report_data'],
+                    isolate = {
+                        'isolate_id': report.report_id,
+                        'isolate_data': self.init_id_tree(report.split_report()),
                         'isolate_report_type': 'id',
-                        'isolate_date': report['report_date']
-                    })
-            document_tree['lab_reports'] = lab_reports
-            try:
-                document_tree['organism_summary'] = self.init_org_summary_tree(lab_reports)
-            except:
-                return {"error":"Failed to build organism_summary branch"}
+                        'isolate_date': report.report_date
+                    }
+                try:
+                    self.update_org_summary_tree(isolate, org_summary_tree)
+                except:
+                    return {"error":"Failed to build organism_summary branch"}
+                lab_reports.append(isolate)
+            #Error entries follow the isolates, to be logged and removed by BuildDatabase.check_errors
+            document_tree['lab_reports'] = lab_reports + errors
+            document_tree['organism_summary'] = org_summary_tree
             return document_tree
         except:
             return {"error":"Fatal error when building document tree"}
 
-    def init_org_summary_tree(self, lab_reports):
-        """Build organism summary - unique organism and MIC data from from report
+    def update_org_summary_tree(self, isolate, org_summary_tree):
+        """Add isolate to organism summary - unique organism and MIC data from from report
+        params:
+        isolate -- tree structure for a laboratory report
+        org_summary_tree -- list of organism summary branches built so far, updated in place"""
+
+        if isolate['isolate_report_type'] == 'id':
+            return
+        isolate_summary = {}
+        isolate_data = isolate['isolate_data']
+        #Get organism name
+        org = isolate_data['AstTestInfo']['SelectedOrg']['orgFullName']
+        isolate_summary['organism_name'] = org
+        isolate_summary['mic_data'] = []
+        #Get drug data
+        drug_data = isolate_data['AstDetailedInfo']
+        for drug in drug_data:
+            if type(drug['details']['mic']) == str:
+                drug_result = drug['details']['interpretation']
+                key = 'interpretation'
+            else:
+                drug_result = drug['details']['mic']
+                key = 'mic'
+            isolate_summary['mic_data'].append({'drug':drug['drug'], key: drug_result})
+        #If this organism is not unique in MIC values/organism species, do not add to tree
+        if isolate_summary not in [branch['isolate_data'] for branch in org_summary_tree]:
+            org_summary_tree.append({
+                'isolate_id': 'isolate_'+str(len(org_summary_tree)),
+                'isolate_data': isolate_summary,
+                'isolate_date': isolate['isolate_date']
+            })
+
+    def init_id_tree(self, report_array):
+        """Build a size-bounded tree for an identification report from its open, close and self-closing element rows, in
+        place of the raw report strings. Each element is a dictionary of its name and attributes, with the elements it
+        encloses listed in document order under children. At most max_id_elements elements are kept and string values
+        are cut to max_id_value_length; the truncated flag records whether either bound was hit
         params:
-        lab_reports -- tree structure for laboratory reports"""
-
-        org_summary_array = []
-        org_summary_tree = []
-        iso_num = 0
-        for isolate_branch in lab_reports:
-            if 'error' not in isolate_branch.keys():
-                if isolate_branch['isolate_report_type'] != 'id':
-                    isolate_summary = {}
-                    id_ = isolate_branch['isolate_id']
-                    isolate_data = isolate_branch['isolate_data']
-                    #Get organism name
-                    org = isolate_data['AstTestInfo']['SelectedOrg']['orgFullName']
-                    isolate_summary['organism_name'] = org
-                    isolate_summary['mic_data'] = []
-                    #Get drug data
-                    drug_data = isolate_data['AstDetailedInfo']
-                    for drug in drug_data:
-                        if type(drug['details']['mic']) == str:
-                            drug_result = drug['details']['interpretation']
-                            key = 'interpretation'
-                        else:
-                            drug_result = drug['details']['mic']
-                            key = 'mic'
-                        isolate_summary['mic_data'].append({'drug':drug['drug'], key: drug_result})
-                    #If this organism is not unique in MIC values/organism species, do not add to tree
-                    if isolate_summary not in org_summary_array:
-                        org_summary_tree.append({
-                            'isolate_id': 'isolate_'+str(iso_num),
-                            'isolate_data': isolate_summary,
-                            'isolate_date': isolate_branch['isolate_date']
-                        })
-                        iso_num += 1
-                        org_summary_array.append(isolate_summary)
-        return org_summary_tree
+        report_array -- array of strings of report elements, as split from source_xmlstring"""
+
+        root = {'children': []}
+        #Stack of open elements as (name, element) pairs; element is None when dropped by the size bound
+        stack = [(None, root)]
+        element_count = 0
+        truncated = False
+        for row in report_array:
+            #Drop source_xmlstring
+            if row.find("source_xmlstring") != -1:
+                continue
+            #Close the matching element, along with any left unclosed inside it
+            if row.startswith("/"):
+                name = row[1:].strip()
+                if any(open_name == name for open_name, _ in stack[1:]):
+                    while stack.pop()[0] != name:
+                        pass
+                continue
+            self_closing = row.endswith("/")
+            name, _, attributes = row.rstrip("/").strip().partition(" ")
+            element_count += 1
+            parent = stack[-1][1]
+            if parent is None or element_count > self.max_id_elements:
+                element = None
+                truncated = True
+            else:
+                element = {'element': intern(name)}
+                if attributes.strip():
+                    #Intern keys, as the same attribute names repeat across every element and report
+                    element['attributes'] = {intern(key): value for key, value in
+                        self.create_dict(attributes.strip()).items()}
+                    for key, value in element['attributes'].items():
+                        if type(value) == str and len(value) > self.max_id_value_length:
+                            element['attributes'][key] = value[:self.max_id_value_length]
+                            truncated = True
+                parent.setdefault('children', []).append(element)
+            if not self_closing:
+                stack.append((name, element))
+        return {'elements': root['children'], 'element_count': element_count, 'truncated': truncated}
 
     def init_document_tree(self, header, section, document_tree):
         """Create branch and leaves for passed section, add too tree and return structure
@@ -226,12 +306,189 @@ class BuildReportTree:
         else:
             return False
 
+class ScanSources:
+    """Walk one or more source roots (directories, zip/tar archives or ISO disc images) and lazily yield the report
+    files found within them, reading archive and disc image members in place rather than extracting them"""
+
+    zip_extensions = ('.zip',)
+    tar_extensions = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+    iso_extensions = ('.iso',)
+    #Errors raised when reading a corrupt, truncated, encrypted or unsupported source; these are logged and the scan
+    #moves on to the next member or source
+    read_errors = (OSError, EOFError, ValueError, RuntimeError, NotImplementedError, zlib.error, lzma.LZMAError,
+        zipfile.BadZipFile, tarfile.TarError)
+    if pycdlib is not None:
+        read_errors += (pycdlib.pycdlibexception.PyCdlibException,)
+
+    def __init__(self, roots, pattern='reports_isolate', errors=None):
+        """Initialise scanner with source roots
+        params:
+        roots -- path, or list of paths, to directories, archives or disc images
+        pattern -- substring identifying report files, matched case-insensitively
+        errors -- optional list that unreadable sources are logged to"""
+
+        if isinstance(roots, (str, bytes, os.PathLike)):
+            roots = [roots]
+        self.roots = list(roots)
+        self.pattern = pattern.lower()
+        self.errors = errors if errors is not None else []
+
+    def scan(self):
+        """Generator yielding (source_name, content) tuples for every report file under the source roots, where
+        source_name is a readable path for logging and content is the raw bytes of the file"""
+
+        for root in self.roots:
+            root = os.fsdecode(root)
+            if os.path.isdir(root):
+                yield from self.scan_dir(root)
+            elif os.path.isfile(root):
+                yield from self.scan_file(root)
+            else:
+                self.log_error("SOURCE NOT FOUND", root)
+
+    def scan_dir(self, dir_path):
+        """Recursively walk directory tree using os.scandir, yielding report files and the contents of any archives
+        or disc images encountered
+        params:
+        dir_path -- string path of directory to walk"""
+
+        stack = [dir_path]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError:
+                self.log_error("UNABLE TO READ DIRECTORY", current)
+                continue
+            subdirs = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    yield from self.scan_file(entry.path)
+            #Reverse so subdirectories are walked in name order
+            stack.extend(reversed(subdirs))
+
+    def scan_file(self, file_path):
+        """Yield a single report file, or the report members of an archive or disc image
+        params:
+        file_path -- string path of file"""
+
+        name = os.path.basename(file_path).lower()
+        try:
+            if name.endswith(self.zip_extensions):
+                yield from self.scan_zip(file_path)
+            elif name.endswith(self.tar_extensions):
+                yield from self.scan_tar(file_path)
+            elif name.endswith(self.iso_extensions):
+                yield from self.scan_iso(file_path)
+            elif self.is_report(name):
+                yield file_path, self.read_file(file_path)
+        except self.read_errors:
+            self.log_error("UNABLE TO READ SOURCE", file_path)
+
+    def read_file(self, file_path):
+        """Return the content of a plain file as bytes
+        params:
+        file_path -- string path of file"""
+
+        with open(file_path, 'rb') as f:
+            return f.read()
+
+    def scan_zip(self, file_path):
+        """Yield report members of a zip archive without extracting it
+        params:
+        file_path -- string path of zip archive"""
+
+        with zipfile.ZipFile(file_path) as archive:
+            for member in archive.infolist():
+                if not member.is_dir() and self.is_report(member.filename):
+                    member_path = os.path.join(file_path, member.filename)
+                    try:
+                        yield member_path, archive.read(member)
+                    except self.read_errors:
+                        self.log_error("UNABLE TO READ ARCHIVE MEMBER", member_path)
+
+    def scan_tar(self, file_path):
+        """Yield report members of a (optionally compressed) tar archive without extracting it, streaming members in
+        archive order
+        params:
+        file_path -- string path of tar archive"""
+
+        with tarfile.open(file_path, 'r:*') as archive:
+            for member in archive:
+                if member.isfile() and self.is_report(member.name):
+                    member_path = os.path.join(file_path, member.name)
+                    try:
+                        yield member_path, archive.extractfile(member).read()
+                    except self.read_errors:
+                        self.log_error("UNABLE TO READ ARCHIVE MEMBER", member_path)
+
+    def scan_iso(self, file_path):
+        """Yield report members of an ISO 9660 disc image without extracting it. Requires the optional pycdlib package;
+        Joliet or Rock Ridge names are preferred when present so long filenames are preserved
+        params:
+        file_path -- string path of disc image"""
+
+        if pycdlib is None:
+            self.log_error("PYCDLIB NOT INSTALLED, UNABLE TO READ DISC IMAGE", file_path)
+            return
+        iso = pycdlib.PyCdlib()
+        iso.open(file_path)
+        try:
+            if iso.has_joliet():
+                path_type = 'joliet_path'
+            elif iso.has_rock_ridge():
+                path_type = 'rr_path'
+            else:
+                path_type = 'iso_path'
+            for dirname, _, filelist in iso.walk(**{path_type: '/'}):
+                for member_name in filelist:
+                    #Plain ISO 9660 names carry a version suffix e.g. REPORTS_ISOLATE1.XML;1
+                    if self.is_report(member_name.split(';')[0]):
+                        member_path = dirname.rstrip('/') + '/' + member_name
+                        source_name = os.path.join(file_path, member_path.lstrip('/'))
+                        try:
+                            yield source_name, self.read_iso_member(iso, path_type, member_path)
+                        except self.read_errors:
+                            self.log_error("UNABLE TO READ DISC IMAGE MEMBER", source_name)
+        finally:
+            iso.close()
+
+    def read_iso_member(self, iso, path_type, member_path):
+        """Return the content of a disc image member as bytes
+        params:
+        iso -- open pycdlib.PyCdlib object
+        path_type -- keyword naming the directory record type used, e.g. 'joliet_path'
+        member_path -- path of member within the disc image"""
+
+        buffer = io.BytesIO()
+        iso.get_file_from_iso_fp(buffer, **{path_type: member_path})
+        return buffer.getvalue()
+
+    def is_report(self, name):
+        """Return true if the base name of the path is a report file
+        params:
+        name -- file or archive member path"""
+
+        return self.pattern in name.replace('\\', '/').split('/')[-1].lower()
+
+    def log_error(self, message, source):
+        """Print and record a source that could not be read"""
+
+        print("{}: {}".format(message.capitalize(), source))
+        self.errors.append("{} {}. SOURCE: {}".format(str(datetime.now()), message, source))
+
 class BuildDatabase:
-    """Using a supplied mongodb client, database name, and CD-ROM file pathway, this object attempts to populate the designated
-    mongo database with report objects obtained from XML files on the target CD-ROM"""
+    """Using a supplied mongodb client, database name, and one or more source paths (CD-ROM directories, archives or
+    disc images), this object attempts to populate the designated mongo database with report objects obtained from
+    XML files found within them"""
 
     def __init__(self, mongoclient, dbname, dir_path, error_path):
-        """Initislise object and set global variables"""
+        """Initislise object and set global variables
+        params:
+        dir_path -- path, or list of paths, to scan for reports (see ScanSources)"""
 
         self.db = mongoclient[dbname]
         self.file_path = dir_path
@@ -239,23 +496,24 @@ class BuildDatabase:
         self.errors = []
 
     def build(self):
-        """Iterate over files in path specified, if they correspond to a report, add to database"""
+        """Iterate over report files found under the paths specified and add them to database"""
 
-        for file in os.listdir(self.file_path):
-            filename = os.fsdecode(file)
-            if 'reports_isolate' in filename:
-                xml_obj = BuildReportTree(str(self.file_path) + filename)
-                try:
-                    document_tree = xml_obj.build_trees()
-                    #Check for errors, only remove isolate branches that have errors and log errors
-                    document_tree = self.check_errors(document_tree, filename)
-                    if document_tree:
-                        self.insert_report(document_tree, filename)
-                    self.log_errors()
-                except:
-                    print("Fatal error on {}, failed to build document tree".format(filename))
-                    self.errors.append("{} FATAL ERROR, UNABLE TO BUILD DOC TREE. FILENAME: {}".format(str(datetime.now()), filename))
-                    self.log_errors()
+        scanner = ScanSources(self.file_path, errors=self.errors)
+        for filename, content in scanner.scan():
+            try:
+                xml_obj = BuildReportTree(content=content)
+                #Release the raw file content before the document tree is built
+                del content
+                document_tree = xml_obj.build_trees()
+                #Check for errors, only remove isolate branches that have errors and log errors
+                document_tree = self.check_errors(document_tree, filename)
+                if document_tree:
+                    self.insert_report(document_tree, filename)
+            except:
+                print("Fatal error on {}, failed to build document tree".format(filename))
+                self.errors.append("{} FATAL ERROR, UNABLE TO BUILD DOC TREE. FILENAME: {}".format(str(datetime.now()), filename))
+            self.log_errors()
+        self.log_errors()
 
     def check_errors(self, document_tree, filename):
         """Check for errors in document tree and process accordingly
@@ -263,8 +521,8 @@ class BuildDatabase:
         document_tree -- nested hash tables representing the report"""
         for i, report in enumerate(document_tree['lab_reports']):
             if 'error' in report.keys():
-                print('{}: {}'.format(str(self.file_path)+filename, report['error']))
-                self.errors.append("{} ERROR: {} FILENAME: {}".format(str(datetime.now()), report['error'], self.file_path))
+                print('{}: {}'.format(filename, report['error']))
+                self.errors.append("{} ERROR: {} FILENAME: {}".format(str(datetime.now()), report['error'], filename))
                 del document_tree['lab_reports'][i]
                 if len(document_tree['lab_reports']) > 0:
                     document_tree = self.check_errors(document_tree, filename)
@@ -342,9 +600,10 @@ if __name__ == '__main__':
         print("Please specify database name e.g '-dbname database1'")
         exit()
     if 'dir_path' in myargs.keys():
-        dir_path = myargs['dir_path']
+        #Multiple directories, archives or disc images may be given, separated by the OS path separator
+        dir_path = myargs['dir_path'].split(os.pathsep)
     else:
-        print("Please specify target directory e.g '-dir_path C:\data\reports'")
+        print("Please specify target directory, archive or disc image e.g '-dir_path C:\data\reports'")
         exit()
     if 'error_path' in myargs.keys():
         error_path = myargs['error_path']